@@ -5,6 +5,30 @@ from data_tool import clean_from_tags, enrich_from_master
 
 st.set_page_config(layout="wide", page_title="Capsule CSV Data Utility")
 
+def _text_stream(raw_bytes):
+    """Wraps an upload's bytes in a text stream that is decoded incrementally as the CSV is read."""
+    return io.TextIOWrapper(io.BytesIO(raw_bytes), encoding="utf-8-sig", newline="")
+
+# Streamlit reruns the whole script on every widget interaction, so results are cached on the uploaded bytes.
+# Only the most recent uploads are kept, since each entry holds a full output CSV in server memory.
+# Failures raise rather than return, so st.cache_data never stores them.
+CACHE_MAX_ENTRIES = 3
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def _cached_clean(raw_bytes):
+    return clean_from_tags(_text_stream(raw_bytes))
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def _cached_enrich(master_bytes, target_bytes, fuzzy_match):
+    return enrich_from_master(_text_stream(master_bytes), _text_stream(target_bytes), fuzzy_match=fuzzy_match)
+
+def _show_processing_error(error):
+    """Reports a failed clean/enrich run in place of the success message and download button."""
+    if isinstance(error, UnicodeDecodeError):
+        st.error('**This file is not UTF-8 encoded.** In Excel, use *Save As* and choose "CSV UTF-8", then upload it again.')
+    else:
+        st.error(f"**An error occurred during processing:** {error}")
+
 st.title("Capsule CSV Data Utility")
 st.write("A tool to help clean and enrich CSV exports from Capsule CRM.")
 
@@ -28,8 +52,9 @@ with st.expander("📖 How to Use This Tool", expanded=True):
         - *This file **must** contain a `Name` (or `Organisation`) column, and the `Sector` and `Category` columns.*
     2.  **Upload Target File**: This is the file you want to fix. Use the second "Browse files" button to upload your target file (e.g., a list of people).
         - *This file **must** contain an `Organisation` column.*
-    3.  **Process**: The tool will automatically enrich your target file using the information from the master file.
-    4.  **Download**: A "Download Enriched File" button will appear. Click it to save the result. The new file will have `_enriched` added to its name.
+    3.  **(Optional) Fuzzy Matching**: Tick "Also use fuzzy matching" if some organisation names differ slightly between the files (e.g., a typo). Names without an exact match are then matched to the closest name in the master file. This is slower.
+    4.  **Process**: The tool will automatically enrich your target file using the information from the master file.
+    5.  **Download**: A "Download Enriched File" button will appear. Click it to save the result. The new file will have `_enriched` added to its name.
     """)
 
 # --- Sidebar for Mode Selection ---
@@ -72,22 +97,23 @@ if mode == "Clean from Tags":
     
     if uploaded_file is not None:
         with st.spinner("Cleaning file... This may take a moment."):
-            # Streamlit's UploadedFile is a file-like object. We decode it to a text stream.
-            string_io = io.StringIO(uploaded_file.getvalue().decode("utf-8-sig"))
-            
-            output_csv, updated, total = clean_from_tags(string_io)
-            
-            st.success(f"**Processing complete!** {updated} out of {total} rows were updated.")
+            # Streamlit's UploadedFile holds raw bytes. Decoding them as they are read avoids a second full copy as str.
+            try:
+                output_csv, updated, total = _cached_clean(uploaded_file.getvalue())
+            except Exception as e:
+                _show_processing_error(e)
+            else:
+                st.success(f"**Processing complete!** {updated} out of {total} rows were updated.")
             
-            # Get original filename without extension
-            file_base, _ = os.path.splitext(uploaded_file.name)
+                # Get original filename without extension
+                file_base, _ = os.path.splitext(uploaded_file.name)
 
-            st.download_button(
-                label="⬇️ Download Cleaned File",
-                data=output_csv,
-                file_name=f"{file_base}_cleaned.csv",
-                mime="text/csv",
-            )
+                st.download_button(
+                    label="⬇️ Download Cleaned File",
+                    data=output_csv,
+                    file_name=f"{file_base}_cleaned.csv",
+                    mime="text/csv",
+                )
 
 elif mode == "Enrich from Master":
     st.header("Mode: Enrich a Target File Using a Master File")
@@ -111,7 +137,8 @@ elif mode == "Enrich from Master":
 
         **Troubleshooting Tips:**
         - **"No rows were updated" message:**
-            - The most common reason is that the organisation names in the **Target File** do not match the names in the **Master File**. The matching is case-insensitive, but spelling, spacing, and punctuation must be identical (e.g., "Stripe" vs. "Stripe, Inc.").
+            - The most common reason is that the organisation names in the **Target File** do not match the names in the **Master File**. The matching ignores case, punctuation and extra spaces, but the words themselves must be identical (e.g., "Stripe Inc" matches "Stripe, Inc.", but "Stripe" does not).
+            - If names differ only slightly (e.g., a typo such as "Acme Holdings" vs. "Acme Holding"), tick **Also use fuzzy matching**. Organisations without an exact match are then matched to the closest master name starting with the same three characters.
             - Check if the `Sector` and `Category` fields in the target file are already filled. The script only fills in empty values.
         - **Error during processing:**
             - Ensure both uploaded files are valid, uncorrupted CSVs.
@@ -125,24 +152,29 @@ elif mode == "Enrich from Master":
     
     with col2:
         target_file = st.file_uploader("2. Upload the TARGET file to enrich", type="csv")
+
+    fuzzy_match = st.checkbox(
+        "Also use fuzzy matching",
+        help="Slower. Organisations with no exact match are matched to the closest similar name in the master file.",
+    )
         
     if master_file is not None and target_file is not None:
         with st.spinner("Building knowledge base and enriching file..."):
-            master_string_io = io.StringIO(master_file.getvalue().decode("utf-8-sig"))
-            target_string_io = io.StringIO(target_file.getvalue().decode("utf-8-sig"))
-            
-            output_csv, updated, total = enrich_from_master(master_string_io, target_string_io)
-            
-            st.success(f"**Enrichment complete!** {updated} out of {total} rows in the target file were updated.")
+            try:
+                output_csv, updated, total = _cached_enrich(master_file.getvalue(), target_file.getvalue(), fuzzy_match)
+            except Exception as e:
+                _show_processing_error(e)
+            else:
+                st.success(f"**Enrichment complete!** {updated} out of {total} rows in the target file were updated.")
             
-            file_base, _ = os.path.splitext(target_file.name)
-
-            st.download_button(
-                label="⬇️ Download Enriched File",
-                data=output_csv,
-                file_name=f"{file_base}_enriched.csv",
-                mime="text/csv",
-            )
+                file_base, _ = os.path.splitext(target_file.name)
+
+                st.download_button(
+                    label="⬇️ Download Enriched File",
+                    data=output_csv,
+                    file_name=f"{file_base}_enriched.csv",
+                    mime="text/csv",
+                )
 
 st.sidebar.markdown("---")
 
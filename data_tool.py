@@ -1,7 +1,11 @@
 import csv
 import os
 import io
+import sys
+import string
+import difflib
 import argparse
+import contextlib
 
 # --- Part 1: Logic for cleaning from tags ---
 
@@ -36,173 +40,316 @@ CATEGORY_MAPPING = [
     ('Other', 'Other', 99),
 ]
 
-def _process_field_from_tags(row, field_name, sorted_mapping, valid_values, lower_tags_str):
-    """Helper function to update a single field based on tags."""
-    current_value = row.get(field_name, '').strip()
-    if current_value in valid_values:
-        return False
-
-    found_value = None
-    for tag, canonical, rank in sorted_mapping:
-        if tag.lower() in lower_tags_str:
-            found_value = canonical
-            break
-    
+# Rank-sorted copies with the tags lowercased once at import, rather than on every row.
+# Values are interned so every row written with a canonical value shares one string object.
+SECTOR_MAPPING_LOWER = tuple(
+    (sys.intern(tag.lower()), sys.intern(canonical), rank)
+    for tag, canonical, rank in sorted(SECTOR_MAPPING, key=lambda item: item[2])
+)
+CATEGORY_MAPPING_LOWER = tuple(
+    (sys.intern(tag.lower()), sys.intern(canonical), rank)
+    for tag, canonical, rank in sorted(CATEGORY_MAPPING, key=lambda item: item[2])
+)
+
+# A field holding one of these canonical values is already correct and is left untouched.
+VALID_SECTORS = frozenset(canonical for tag, canonical, rank in SECTOR_MAPPING_LOWER)
+VALID_CATEGORIES = frozenset(canonical for tag, canonical, rank in CATEGORY_MAPPING_LOWER)
+
+def _find_canonical(lower_mapping, lower_tags_str):
+    """Returns the canonical value of the best-ranked tag found in the lowercased tags string, or None."""
+    for tag, canonical, rank in lower_mapping:
+        if tag in lower_tags_str:
+            return canonical
+    return None
+
+def _process_field_from_tags(row, field_index, found_value, current_value):
+    """Helper function to update a single field from its tag match, given the field's stripped current value."""
     if found_value and found_value != current_value:
-        row[field_name] = found_value
+        row[field_index] = found_value
         return True
     
     return False
 
-def clean_from_tags(input_file_object):
+def _column_index(header, column_name):
+    """Returns the index of a column in the header row, appending the column if it is missing."""
+    if column_name not in header:
+        header.append(column_name)
+    return header.index(column_name)
+
+def _fit_row(row, header_width, row_width):
+    """
+    Lines a row up with the output header in place.
+
+    Short rows are padded to the input header width, then empty cells are inserted for any columns
+    appended to the header. Cells beyond the input header are kept after those, so overflow data can
+    never be read or written as an appended Sector/Category value.
+    """
+    if len(row) < header_width:
+        row.extend([''] * (header_width - len(row)))
+    if row_width > header_width:
+        row[header_width:header_width] = [''] * (row_width - header_width)
+    return row
+
+def clean_from_tags(input_file_object, output_file_object=None):
     """
     Cleans a CSV file from a file-like object by populating Sector/Category from its Tags column.
     
     Args:
         input_file_object: A file-like object (e.g., from open() or io.StringIO).
+        output_file_object: Optional writable file-like object. If given, rows are streamed
+            straight into it and the returned CSV string is empty.
 
     Returns:
         A tuple containing (output_csv_string, updated_rows_count, total_rows_count).
-    """
-    # Pre-process mappings for efficiency
-    sorted_sector_mapping = sorted(SECTOR_MAPPING, key=lambda item: item[2])
-    sorted_category_mapping = sorted(CATEGORY_MAPPING, key=lambda item: item[2])
-    valid_sectors = {item[1] for item in sorted_sector_mapping}
-    valid_categories = {item[1] for item in sorted_category_mapping}
 
+    Raises:
+        Any error hit while reading or writing the CSV is printed and re-raised, so a partial
+        result is never mistaken for a finished one.
+    """
     updated_rows_count = 0
     total_rows_count = 0
+    # CRM exports repeat the same Tags string across many rows, so each one is only scanned once.
+    tag_cache = {}
     
-    # Use io.StringIO to build the output CSV in memory
-    output_io = io.StringIO()
+    # Stream into the caller's file if given, otherwise build the output CSV in memory
+    output_io = io.StringIO() if output_file_object is None else output_file_object
 
     try:
         with input_file_object as infile:
-            reader = csv.DictReader(infile)
-            if not reader.fieldnames:
+            reader = csv.reader(infile)
+            header = next(reader, None)
+            if not header:
                 return "", 0, 0
 
-            output_fieldnames = reader.fieldnames[:]
-            if 'Sector' not in output_fieldnames:
-                output_fieldnames.append('Sector')
-            if 'Category' not in output_fieldnames:
-                output_fieldnames.append('Category')
-
-            writer = csv.DictWriter(output_io, fieldnames=output_fieldnames)
-            writer.writeheader()
-
-            for row in reader:
-                total_rows_count += 1
-                tags_str = row.get('Tags', '')
-                if not tags_str:
-                    writer.writerow(row)
-                    continue
+            # Resolve column positions once so each row is a plain list rather than a dict.
+            tags_idx = header.index('Tags') if 'Tags' in header else None
+            header_width = len(header)
+            sector_idx = _column_index(header, 'Sector')
+            category_idx = _column_index(header, 'Category')
+            row_width = len(header)
+
+            writer = csv.writer(output_io)
+            writer.writerow(header)
+
+            def _cleaned_rows():
+                nonlocal updated_rows_count, total_rows_count
+                for row in reader:
+                    if not row:
+                        continue
+                    total_rows_count += 1
+                    _fit_row(row, header_width, row_width)
+                    tags_str = row[tags_idx] if tags_idx is not None else ''
+                    if not tags_str:
+                        yield row
+                        continue
+
+                    # Already-clean rows (e.g. a re-run on a cleaned file) skip the tag lookup entirely.
+                    # Empty cells are the common case, so they skip the strip and the set lookup.
+                    current_sector = row[sector_idx]
+                    if current_sector:
+                        current_sector = current_sector.strip()
+                    sector_needed = not current_sector or current_sector not in VALID_SECTORS
+                    current_category = row[category_idx]
+                    if current_category:
+                        current_category = current_category.strip()
+                    category_needed = not current_category or current_category not in VALID_CATEGORIES
+                    if not (sector_needed or category_needed):
+                        yield row
+                        continue
                 
-                lower_tags_str = tags_str.lower()
-                sector_updated = _process_field_from_tags(row, 'Sector', sorted_sector_mapping, valid_sectors, lower_tags_str)
-                category_updated = _process_field_from_tags(row, 'Category', sorted_category_mapping, valid_categories, lower_tags_str)
-
-                if sector_updated or category_updated:
-                    updated_rows_count += 1
+                    resolved = tag_cache.get(tags_str)
+                    if resolved is None:
+                        lower_tags_str = tags_str.lower()
+                        resolved = tag_cache[tags_str] = (
+                            _find_canonical(SECTOR_MAPPING_LOWER, lower_tags_str),
+                            _find_canonical(CATEGORY_MAPPING_LOWER, lower_tags_str),
+                        )
+                    sector_found, category_found = resolved
+
+                    sector_updated = sector_needed and _process_field_from_tags(row, sector_idx, sector_found, current_sector)
+                    category_updated = category_needed and _process_field_from_tags(row, category_idx, category_found, current_category)
+
+                    if sector_updated or category_updated:
+                        updated_rows_count += 1
                 
-                writer.writerow(row)
+                    yield row
+
+            # writerows drives the generator from C instead of a writerow call per row.
+            writer.writerows(_cleaned_rows())
 
-        return output_io.getvalue(), updated_rows_count, total_rows_count
+        output_csv = output_io.getvalue() if output_file_object is None else ""
+        return output_csv, updated_rows_count, total_rows_count
 
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
-        return "", 0, 0
+        raise
 
 
 # --- Part 2: Logic for enriching from a master file ---
 
-def enrich_from_master(master_file_object, target_file_object):
+# Deletes all ASCII punctuation, so "Stripe, Inc." and "Stripe Inc" share a key.
+ORG_NAME_TRANSLATION = str.maketrans('', '', string.punctuation)
+
+def _normalise_org_name(org_name):
+    """Returns the matching key for an organisation name: lowercased, without punctuation, whitespace collapsed."""
+    return ' '.join(org_name.translate(ORG_NAME_TRANSLATION).lower().split())
+
+# Minimum difflib similarity ratio for a fuzzy organisation match to be accepted.
+FUZZY_MATCH_CUTOFF = 0.9
+
+def _fuzzy_org_key(org_key, master_blocks):
+    """Returns the closest master key in the same block (first three characters) as org_key, or None."""
+    candidates = master_blocks.get(org_key[:3])
+    if not candidates:
+        return None
+    matches = difflib.get_close_matches(org_key, candidates, n=1, cutoff=FUZZY_MATCH_CUTOFF)
+    return matches[0] if matches else None
+
+def enrich_from_master(master_file_object, target_file_object, output_file_object=None, fuzzy_match=False):
     """
     Enriches a target CSV using data from a master CSV, using file-like objects.
 
     Args:
         master_file_object: A file-like object for the master CSV.
         target_file_object: A file-like object for the target CSV.
+        output_file_object: Optional writable file-like object. If given, rows are streamed
+            straight into it and the returned CSV string is empty.
+        fuzzy_match: If True, organisations with no exact match fall back to the closest master
+            name that starts with the same three characters.
 
     Returns:
         A tuple containing (output_csv_string, updated_rows_count, total_rows_count).
+
+    Raises:
+        Any error hit while reading or writing the CSV is printed and re-raised, so a partial
+        result is never mistaken for a finished one.
     """
     # --- Step 1: Build knowledge base from master file ---
+    # Keyed by the normalised organisation name; the first row seen for an organisation wins.
     organisation_data_map = {}
-    seen_orgs_lower = set()
     try:
         with master_file_object as infile:
-            reader = csv.DictReader(infile)
+            reader = csv.reader(infile)
+            header = next(reader, [])
+            name_column = 'Name' if 'Name' in header else 'Organisation'
+            header_width = len(header)
+            # Missing columns are None and read as '', so overflow cells are never mistaken for them.
+            name_idx, sector_idx, category_idx = (
+                header.index(column) if column in header else None
+                for column in (name_column, 'Sector', 'Category')
+            )
+
             for row in reader:
-                org_name = row.get('Name', row.get('Organisation', '')).strip()
-                if not org_name:
+                if not row:
+                    continue
+                _fit_row(row, header_width, header_width)
+                org_key = _normalise_org_name(row[name_idx]) if name_idx is not None else ''
+                if not org_key:
                     continue
                 
-                if org_name.lower() not in seen_orgs_lower:
-                    organisation_data_map[org_name] = {
-                        'Sector': row.get('Sector', ''),
-                        'Category': row.get('Category', '') 
-                    }
-                    seen_orgs_lower.add(org_name.lower())
+                if org_key not in organisation_data_map:
+                    # Only a handful of distinct Sector/Category values recur across the master, so intern them.
+                    master_data = (
+                        sys.intern(row[sector_idx]) if sector_idx is not None else '',
+                        sys.intern(row[category_idx]) if category_idx is not None else '',
+                    )
+                    # Entries with nothing to copy are kept (first row still wins) but stored as None.
+                    organisation_data_map[org_key] = master_data if any(master_data) else None
         print(f"Knowledge base built: Found data for {len(organisation_data_map)} unique organisations.")
     except Exception as e:
         print(f"An error occurred while reading the master file: {e}")
-        return "", 0, 0
+        raise
 
     # --- Step 2: Enrich the target file ---
     updated_rows_count = 0
     total_rows_count = 0
-    lower_to_original_key_map = {k.lower(): k for k in organisation_data_map.keys()}
+    # Fuzzy candidates are blocked on their first three characters so each miss is only compared to a few names.
+    master_blocks = {}
+    if fuzzy_match:
+        for org_key in organisation_data_map:
+            master_blocks.setdefault(org_key[:3], []).append(org_key)
     
-    # Use io.StringIO to build the output CSV in memory
-    output_io = io.StringIO()
+    # Stream into the caller's file if given, otherwise build the output CSV in memory
+    output_io = io.StringIO() if output_file_object is None else output_file_object
 
     try:
         with target_file_object as infile:
-            reader = csv.DictReader(infile)
-            if not reader.fieldnames:
+            reader = csv.reader(infile)
+            header = next(reader, None)
+            if not header:
                 return "", 0, 0
             
-            output_fieldnames = reader.fieldnames[:]
-            if 'Sector' not in output_fieldnames:
-                output_fieldnames.append('Sector')
-            if 'Category' not in output_fieldnames:
-                output_fieldnames.append('Category')
-
-            writer = csv.DictWriter(output_io, fieldnames=output_fieldnames)
-            writer.writeheader()
-
-            for row in reader:
-                total_rows_count += 1
-                was_updated = False
+            organisation_idx = header.index('Organisation') if 'Organisation' in header else None
+            header_width = len(header)
+            sector_idx = _column_index(header, 'Sector')
+            category_idx = _column_index(header, 'Category')
+            row_width = len(header)
+
+            writer = csv.writer(output_io)
+            writer.writerow(header)
+            # Each distinct Organisation cell is joined against the master once, then reused.
+            join_cache = {}
+
+            def _enriched_rows():
+                nonlocal updated_rows_count, total_rows_count
+                for row in reader:
+                    if not row:
+                        continue
+                    total_rows_count += 1
+                    was_updated = False
+                    _fit_row(row, header_width, row_width)
                 
-                org_name = row.get('Organisation', '').strip()
-                original_key = lower_to_original_key_map.get(org_name.lower())
+                    org_cell = row[organisation_idx] if organisation_idx is not None else ''
+                    correct_data = join_cache.get(org_cell)
+                    if correct_data is None and org_cell not in join_cache:
+                        org_key = _normalise_org_name(org_cell)
+                        if not master_blocks or org_key in organisation_data_map:
+                            correct_data = join_cache[org_cell] = organisation_data_map.get(org_key)
+                        elif not row[sector_idx].strip() or not row[category_idx].strip():
+                            # A difflib pass is only paid for when the row still has an empty field to fill.
+                            fuzzy_key = _fuzzy_org_key(org_key, master_blocks)
+                            correct_data = join_cache[org_cell] = organisation_data_map.get(fuzzy_key)
                 
-                if original_key:
-                    correct_data = organisation_data_map[original_key]
+                    if correct_data:
+                        master_sector, master_category = correct_data
                     
-                    if not row.get('Sector', '').strip() and correct_data.get('Sector'):
-                        row['Sector'] = correct_data['Sector']
-                        was_updated = True
+                        if master_sector and not row[sector_idx].strip():
+                            row[sector_idx] = master_sector
+                            was_updated = True
                     
-                    if not row.get('Category', '').strip() and correct_data.get('Category'):
-                        row['Category'] = correct_data['Category']
-                        was_updated = True
+                        if master_category and not row[category_idx].strip():
+                            row[category_idx] = master_category
+                            was_updated = True
                 
-                if was_updated:
-                    updated_rows_count += 1
+                    if was_updated:
+                        updated_rows_count += 1
                 
-                writer.writerow(row)
+                    yield row
 
-        return output_io.getvalue(), updated_rows_count, total_rows_count
+            # writerows drives the generator from C instead of a writerow call per row.
+            writer.writerows(_enriched_rows())
+
+        output_csv = output_io.getvalue() if output_file_object is None else ""
+        return output_csv, updated_rows_count, total_rows_count
 
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
-        return "", 0, 0
+        raise
 
 # --- Part 3: Main execution block with command-line parsing ---
 
+@contextlib.contextmanager
+def _atomic_output(output_file_path):
+    """Yields a temp file beside output_file_path that only replaces it if the block succeeds."""
+    temp_path = f"{output_file_path}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as outfile:
+            yield outfile
+        os.replace(temp_path, output_file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
 def main():
     parser = argparse.ArgumentParser(
         description="A tool for cleaning and enriching CSV data for Capsule.",
@@ -226,21 +373,21 @@ def main():
     )
     parser_enrich.add_argument('--master', required=True, help='The path to the master organisation CSV file.')
     parser_enrich.add_argument('--target', required=True, help='The path to the target (e.g., people) CSV file to enrich.')
+    parser_enrich.add_argument('--fuzzy', action='store_true', help='Fall back to close (fuzzy) name matches for organisations with no exact match.')
 
     args = parser.parse_args()
 
     if args.command == 'clean':
         print(f"--- Running: Clean From Tags on file: {args.file} ---")
         try:
-            with open(args.file, mode='r', newline='', encoding='utf-8-sig') as infile:
-                output_csv, updated, total = clean_from_tags(infile)
-            
             file_dir, file_name = os.path.split(args.file)
             file_base, file_ext = os.path.splitext(file_name)
             output_file_path = os.path.join(file_dir, f"{file_base}_cleaned{file_ext}")
 
-            with open(output_file_path, 'w', encoding='utf-8') as outfile:
-                outfile.write(output_csv)
+            # Rows are streamed to a temp file as they are processed, which is only moved into place on success.
+            with open(args.file, mode='r', newline='', encoding='utf-8-sig') as infile, \
+                 _atomic_output(output_file_path) as outfile:
+                _, updated, total = clean_from_tags(infile, outfile)
 
             print("\nProcessing complete.")
             print(f"Total rows processed: {total}")
@@ -249,20 +396,20 @@ def main():
 
         except FileNotFoundError:
             print(f"Error: The input file was not found at '{args.file}'")
+        except Exception:
+            print(f"Error: Processing failed, so no cleaned file was written to '{output_file_path}'.")
 
     elif args.command == 'enrich':
         print(f"--- Running: Enrich From Master ---")
         try:
-            with open(args.master, mode='r', newline='', encoding='utf-8-sig') as master_file, \
-                 open(args.target, mode='r', newline='', encoding='utf-8-sig') as target_file:
-                output_csv, updated, total = enrich_from_master(master_file, target_file)
-
             file_dir, file_name = os.path.split(args.target)
             file_base, file_ext = os.path.splitext(file_name)
             output_file_path = os.path.join(file_dir, f"{file_base}_enriched{file_ext}")
 
-            with open(output_file_path, 'w', encoding='utf-8') as outfile:
-                outfile.write(output_csv)
+            with open(args.master, mode='r', newline='', encoding='utf-8-sig') as master_file, \
+                 open(args.target, mode='r', newline='', encoding='utf-8-sig') as target_file, \
+                 _atomic_output(output_file_path) as outfile:
+                _, updated, total = enrich_from_master(master_file, target_file, outfile, fuzzy_match=args.fuzzy)
 
             print("\nProcessing complete.")
             print(f"Total rows processed: {total}")
@@ -270,6 +417,8 @@ def main():
             print(f"Enriched data saved to: {output_file_path}")
         except FileNotFoundError:
             print(f"Error: One of the files was not found. Check paths for --master and --target.")
+        except Exception:
+            print(f"Error: Processing failed, so no enriched file was written to '{output_file_path}'.")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file